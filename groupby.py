@@ -5,6 +5,11 @@ import random
 import logging
 import gc
 import sys
+import heapq
+import itertools
+import json
+import contextlib
+import functools
 
 from collections import defaultdict
 from datetime import datetime
@@ -29,7 +34,13 @@ class GroupByStatement(object):
     >>> g.remove_log()
     """
 
-    def __init__(self, max_num_files=100, max_hashmap_entries=1000000, max_memory=-1, request_id=None):
+    # Lower bounds for the values derived from max_memory by _apply_max_memory
+    _MIN_HASHMAP_ENTRIES = 16
+    _MIN_NUM_FILES = 2
+
+    def __init__(self, max_num_files=100, max_hashmap_entries=1000000, max_memory=-1, request_id=None,
+                 hot_key_fraction=-1, limit=-1, key_range=None, key_filter=None, checkpoint=False,
+                 scheduler=None, ordered=True, max_hot_keys=64):
         """
         :param max_num_files: The maximum number of files to merge at one step using MergeFileIterator
         :param max_hashmap_entries: The maximum number of (key, value) entries to store in memory before
@@ -39,6 +50,27 @@ class GroupByStatement(object):
                            max_num_files once the first (key, value) has been processed (in order to be able to compute
                            the size of (key, value) pair.
         :param request_id: Used for testing
+        :param hot_key_fraction: If different from -1, enables hot key handling for skewed inputs.
+                                 A key holding at least hot_key_fraction * max_hashmap_entries values in a spilled
+                                 hashmap is marked as hot. From then on its values are appended to a dedicated hot key
+                                 file instead of the dump files, and are streamed back when the key is output.
+                                 Has to be -1 or in (0, 1].
+        :param limit: If different from -1, only the first limit keys (in ascending order) are returned.
+                      Has to be -1 or positive.
+                      Each spill only keeps its limit smallest keys, after which larger keys are dropped at ingestion,
+                      and merges stop after limit keys.
+        :param key_range: If not None, a (low, high) tuple: only keys with low <= key < high are kept
+        :param key_filter: If not None, a predicate on keys: only keys for which it returns True are kept
+        :param checkpoint: If True, a manifest of the finished spills and merge stages is kept in the request folder,
+                           so that an interrupted request can be continued with resume().
+                           Pass a request_id in order to be able to find the request folder again; groupBy fails
+                           with a ValueError if that folder already exists.
+        :param scheduler: If not None, a GroupByScheduler shared with other requests. Until its result is released,
+                          max_memory is replaced by the quota handed out by the scheduler, and the bytes written on
+                          disk count against its disk budget.
+        :param max_hot_keys: The maximum number of hot keys. Once reached, no more keys are detected as hot.
+        :param ordered: If False and the input fits in memory, the groups are returned in no particular order, which
+                        saves sorting the keys. Groups spilled on disk are always returned in ascending key order.
         """
 
         self._num_files = 0
@@ -46,19 +78,51 @@ class GroupByStatement(object):
         self._max_hashmap_entries = max_hashmap_entries
         self._request_id = request_id
         self._max_memory = max_memory
+        # size in memory of a (key, value) pair, computed from the first processed pair
+        self._kv_size = None
+        if hot_key_fraction != -1 and not 0 < hot_key_fraction <= 1:
+            raise ValueError("hot_key_fraction has to be -1 or in (0, 1], got {}".format(hot_key_fraction))
+        self._hot_key_fraction = hot_key_fraction
+        self._max_hot_keys = max_hot_keys
+        # hot key -> filename of the append-only file holding its values
+        self._hot_keys = {}
+        if limit != -1 and limit < 1:
+            raise ValueError("limit has to be -1 or positive, got {}".format(limit))
+        self._limit = limit
+        self._key_range = key_range
+        self._key_filter = key_filter
+        # When limit is set, keys greater than this bound can't be among the first limit keys of the result
+        self._key_upper_bound = None
+        self._checkpoint = checkpoint
+        # "chunking" while the input is consumed, "merging" once all of it has been dumped to disk
+        self._stage = "chunking"
+        self._scheduler = scheduler
+        self._ordered = ordered
         self._logger = None
+        self._log_handler = None
         # number of hashmap writes on disk during _chunk_input_into_dump_files
         self.spills = 0
         # number of merge stages done to reduce the number of dump files to less than equal to max_num_files
         self.num_merge_stages = 0
         # number of processed entries - (key, value) pairs
         self.total_num_entries = 0
+        # number of processed entries dropped by key_range, key_filter or limit
+        self.num_filtered_entries = 0
 
-    def _get_dump_filename(self, index):
+    def _get_dump_filename(self, index, merge_stage=None):
         """
-        Helper method which returns the path of a dump file given it's index
+        Helper method which returns the path of a dump file given it's index and the merge stage which produced it
+        (0 for the dumps of _chunk_input_into_dump_files). Defaults to the current merge stage.
         """
-        return "{}/dump_{}".format(self._request_id, index)
+        if merge_stage is None:
+            merge_stage = self.num_merge_stages
+        return "{}/dump_{}_{}".format(self._request_id, merge_stage, index)
+
+    def _get_hot_key_filename(self, key):
+        """
+        Helper method which returns the path of the append-only values file of a hot key
+        """
+        return "{}/hot_{}".format(self._request_id, key)
 
     def _get_merge_filename(self):
         """
@@ -66,6 +130,135 @@ class GroupByStatement(object):
         """
         return "{}/_merge".format(self._request_id)
 
+    @staticmethod
+    def _get_manifest_filename(request_id):
+        """
+        Helper method which returns the path of the checkpoint manifest of a request
+        """
+        return "{}/manifest.json".format(request_id)
+
+    @staticmethod
+    def load_manifest(request_id):
+        """
+        Returns the checkpoint manifest of the given request folder
+        """
+        with open(GroupByStatement._get_manifest_filename(request_id)) as f:
+            return json.load(f)
+
+    @staticmethod
+    def checkpoint_input_offset(request_id):
+        """
+        Returns the number of input (key, value) pairs covered by the last checkpoint of the given request folder.
+        resume() needs the input stream from at most this position onwards.
+        """
+        return GroupByStatement.load_manifest(request_id)["input_offset"]
+
+    def _save_checkpoint(self):
+        """
+        Atomically replaces the manifest with the current state of the request.
+        Does nothing if checkpointing is disabled.
+
+        The manifest is only written once a spill or a merge stage has completed, so everything it refers to is
+        complete on disk. Hot key files are append-only, so their sizes are recorded as well in order to drop values
+        appended after the last checkpoint.
+        """
+        if not self._checkpoint:
+            return
+
+        manifest = {
+            "stage": self._stage,
+            "input_offset": self.total_num_entries,
+            "num_files": self._num_files,
+            "spills": self.spills,
+            "num_merge_stages": self.num_merge_stages,
+            "num_filtered_entries": self.num_filtered_entries,
+            "max_num_files": self._max_num_files,
+            "max_hashmap_entries": self._max_hashmap_entries,
+            "max_memory": self._max_memory,
+            "hot_key_fraction": self._hot_key_fraction,
+            "max_hot_keys": self._max_hot_keys,
+            "ordered": self._ordered,
+            "limit": self._limit,
+            "key_range": self._key_range,
+            "key_upper_bound": self._key_upper_bound,
+            "hot_keys": {str(key): os.path.getsize(filename) for key, filename in self._hot_keys.items()}
+        }
+
+        # Make the renames of the dump files durable before the manifest refers to them
+        self._fsync_request_folder()
+
+        manifest_filename = self._get_manifest_filename(self._request_id)
+        with open(manifest_filename + ".tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_filename + ".tmp", manifest_filename)
+        self._fsync_request_folder()
+
+    def _fsync_request_folder(self):
+        """
+        Flushes the entries (creations, renames) of the request folder to disk
+        """
+        fd = os.open(self._request_id, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_dump_file(self, key_values_list, filename):
+        """
+        Writes a dump file with write_key_values_to_file.
+        If checkpointing is enabled, the file is written under a temporary name, synced to disk and then atomically
+        renamed, so that after a machine crash the manifest never refers to a partially written dump file.
+        """
+        if not self._checkpoint:
+            self.write_key_values_to_file(key_values_list, filename)
+            return
+
+        self.write_key_values_to_file(key_values_list, filename + ".tmp")
+        with open(filename + ".tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(filename + ".tmp", filename)
+
+    def _restore_checkpoint(self, manifest):
+        """
+        Restores the state of the request from its manifest and removes the hot key values appended after it was
+        written.
+        """
+        self._stage = manifest["stage"]
+        self.total_num_entries = manifest["input_offset"]
+        self._num_files = manifest["num_files"]
+        self.spills = manifest["spills"]
+        self.num_merge_stages = manifest["num_merge_stages"]
+        self.num_filtered_entries = manifest["num_filtered_entries"]
+        self._max_num_files = manifest["max_num_files"]
+        self._max_hashmap_entries = manifest["max_hashmap_entries"]
+        self._max_memory = manifest["max_memory"]
+        self._hot_key_fraction = manifest["hot_key_fraction"]
+        self._max_hot_keys = manifest["max_hot_keys"]
+        self._ordered = manifest["ordered"]
+        self._limit = manifest["limit"]
+        self._key_range = tuple(manifest["key_range"]) if manifest["key_range"] is not None else None
+        self._key_upper_bound = manifest["key_upper_bound"]
+        self._checkpoint = True
+
+        self._hot_keys = {}
+        for key, size in manifest["hot_keys"].items():
+            key = int(key)
+            self._hot_keys[key] = self._get_hot_key_filename(key)
+            if os.path.getsize(self._hot_keys[key]) < size:
+                raise ValueError("Unable to resume: hot key file {} is shorter than its checkpointed size {}".format(
+                    self._hot_keys[key], size))
+            with open(self._hot_keys[key], "a") as f:
+                f.truncate(size)
+
+        # Hot keys detected after the last checkpoint are going to be detected again
+        hot_key_filenames = set(self._hot_keys.values())
+        for filename in os.listdir(self._request_id):
+            filename = "{}/{}".format(self._request_id, filename)
+            if filename.startswith(self._get_hot_key_filename("")) and filename not in hot_key_filenames:
+                os.remove(filename)
+
     @staticmethod
     def write_key_values_to_file(key_values_list, filename):
         f = open(filename, "w")
@@ -90,42 +283,183 @@ class GroupByStatement(object):
             if self._max_num_files < 2:
                 error_msg = "Unable to merge dump files: max_num_files has to be greater than 1"
                 self._logger.error(error_msg)
-                # Clean up
-                shutil.rmtree(self._request_id)
-                raise error_msg
+                # The request folder is cleaned up by _clean_up_failed_request
+                raise ValueError(error_msg)
+
+            with self._scheduler.merge_slot() if self._scheduler else contextlib.nullcontext():
+                current_merge_file = self._merge_stage()
+
+            self._logger.info(
+                "At merge stage {} merged {} dump files into {}".format(self.num_merge_stages, self._num_files,
+                                                                        current_merge_file))
+
+            self._num_files = current_merge_file
+            self.num_merge_stages += 1
+            self._save_checkpoint()
 
-            current_merge_file = 0
+        self._logger.info("Number of dump files after _merge_dump_files: {}".format(self._num_files))
 
-            # Merge at most _max_num_files at once
-            for index in range(0, self._num_files, self._max_num_files):
-                # List of current files to be merged into one
-                filename_list = [self._get_dump_filename(file_id)
-                                 for file_id in range(index, min(self._num_files, index + self._max_num_files))]
-                merge_filename = self._get_merge_filename()
-                dump_filename = self._get_dump_filename(current_merge_file)
+    def _merge_stage(self):
+        """
+        Does one merge stage of _merge_dump_files, merging the dump files at most _max_num_files at once
 
+        :return: the number of dump files after the merge stage
+        """
+        current_merge_file = 0
+        # The scheduler may change _max_num_files at any time
+        max_num_files = self._max_num_files
+
+        # Merge at most max_num_files at once
+        for index in range(0, self._num_files, max_num_files):
+            # List of current files to be merged into one
+            filename_list = [self._get_dump_filename(file_id)
+                             for file_id in range(index, min(self._num_files, index + max_num_files))]
+            merge_filename = self._get_merge_filename()
+            dump_filename = self._get_dump_filename(current_merge_file, self.num_merge_stages + 1)
+            merged_size = sum(os.path.getsize(filename) for filename in filename_list if os.path.exists(filename))
+
+            # Merged dump files only appear through an atomic rename, so if dump_filename exists this group has
+            # already been merged before the request was interrupted
+            if not os.path.exists(dump_filename):
                 if len(filename_list) == 1:
-                    shutil.move(filename_list[0], dump_filename)
+                    os.replace(filename_list[0], dump_filename)
+                    merged_size = 0
                 else:
-                    self.write_key_values_to_file(MergeFileIterator(filename_list), merge_filename)
+                    # The merge file is at most as large as the merged dump files, which are only removed once it is
+                    # complete
+                    self._reserve_disk(merged_size)
+                    merge_file_iterator = MergeFileIterator(filename_list)
+                    self._write_dump_file(self._apply_limit(merge_file_iterator), merge_filename)
+                    merge_file_iterator.close()
+                    self._release_disk(merged_size - os.path.getsize(merge_filename))
 
-                    # Remove dump files and rename the merge file to a dump file
-                    for filename in filename_list:
-                        os.remove(filename)
+                    # Rename the merge file to a dump file of the next merge stage
+                    os.replace(merge_filename, dump_filename)
 
-                    # Recycle merged dump files
-                    shutil.move(merge_filename, dump_filename)
+            # Remove the merged dump files
+            for filename in filename_list:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            self._release_disk(merged_size)
 
-                current_merge_file += 1
+            current_merge_file += 1
 
-            self._logger.info(
-                "At merge stage {} merged {} dump files into {}".format(self.num_merge_stages, self._num_files,
-                                                                        current_merge_file))
+        return current_merge_file
 
-            self._num_files = current_merge_file
-            self.num_merge_stages += 1
+    def _apply_max_memory(self):
+        """
+        Sets max_hashmap_entries and max_num_files based on max_memory and the size of a (key, value) pair.
+        Both are clamped to sane minimums, so that a small quota handed out by a busy scheduler still lets the
+        request spill and merge.
 
-        self._logger.info("Number of dump files after _merge_dump_files: {}".format(self._num_files))
+        May run on the thread of the scheduler while the request reads both attributes, so each of them is assigned
+        exactly once, with its final value.
+        """
+        max_entries = self._max_memory // self._kv_size
+        max_hashmap_entries = max(self._MIN_HASHMAP_ENTRIES, max_entries)
+        # Add a maximum limit of 1000 for max_num_files
+        max_num_files = min(1000, max(self._MIN_NUM_FILES, max_entries))
+
+        self._max_hashmap_entries = max_hashmap_entries
+        self._max_num_files = max_num_files
+
+        if self._logger:
+            self._logger.info("Setting max_hashmap_entries={} and max_num_files={} based on max_memory={}bytes"
+                              .format(self._max_hashmap_entries, self._max_num_files, self._max_memory))
+
+    def set_memory_quota(self, max_memory):
+        """
+        Called by the scheduler whenever the memory quota of this request changes.
+        While consuming the input it takes effect at the next (key, value) pair: a smaller quota forces an earlier
+        spill, a larger one lets the hashmap grow. During the merge stages it takes effect at the next merge stage,
+        through max_num_files.
+        """
+        self._max_memory = max_memory
+        if self._kv_size is not None:
+            self._apply_max_memory()
+
+    def _reserve_disk(self, num_bytes):
+        """
+        Accounts for num_bytes written on disk by this request against the disk budget of the scheduler.
+        Raises an IOError if the budget is exceeded.
+        """
+        if self._scheduler is not None:
+            self._scheduler.reserve_disk(self._request_id, num_bytes)
+
+    def _release_disk(self, num_bytes=None):
+        """
+        Releases num_bytes of the disk space accounted for by this request, or all of it if num_bytes is None
+        """
+        if self._scheduler is not None:
+            self._scheduler.release_disk(self._request_id, num_bytes)
+
+    def _release_request(self, request_id, keep_disk=False):
+        """
+        Gives the memory quota of a request back to the scheduler, as well as its disk space unless keep_disk is True.
+        Called once the result of the request has been released, or when the request fails.
+        """
+        self._scheduler.unregister(self)
+        if not keep_disk:
+            self._scheduler.release_disk(request_id)
+
+    def _get_release_callback(self):
+        """
+        Returns the callback which releases the current request, to be called by its result iterator once it has
+        been released. None if there is no scheduler.
+        """
+        if self._scheduler is None:
+            return None
+        return functools.partial(self._release_request, self._request_id)
+
+    def _clean_up_failed_request(self):
+        """
+        Called when the request fails. Gives its memory quota back to the scheduler and, unless checkpointing is
+        enabled, removes the request folder and releases its disk space. With checkpointing both are kept for resume().
+        """
+        self._logger.exception("Request failed")
+        if self._scheduler is not None:
+            self._release_request(self._request_id, keep_disk=self._checkpoint)
+        if not self._checkpoint:
+            shutil.rmtree(self._request_id, ignore_errors=True)
+
+    def _apply_limit(self, key_values_iterator):
+        """
+        Truncates an iterator of (key, list(values)), ordered by key, to its first limit entries
+        """
+        if self._limit < 0:
+            return key_values_iterator
+        return itertools.islice(key_values_iterator, self._limit)
+
+    def _accept_key(self, key):
+        """
+        Returns False if the key has been filtered out by key_range, key_filter or limit
+        """
+        if self._key_range is not None and not (self._key_range[0] <= key < self._key_range[1]):
+            return False
+        if self._key_upper_bound is not None and key > self._key_upper_bound:
+            return False
+        if self._key_filter is not None and not self._key_filter(key):
+            return False
+        return True
+
+    def _trim_hashmap_to_limit(self, hashmap):
+        """
+        Removes all but the limit smallest keys from the hashmap.
+
+        Any key among the first limit keys of the result is also among the limit smallest keys of each hashmap it
+        appears in, so the removed keys can't be part of the result. The largest remaining key becomes an upper bound
+        for the keys accepted at ingestion.
+        """
+        if len(hashmap) < self._limit:
+            return
+
+        smallest_keys = heapq.nsmallest(self._limit, hashmap.keys())
+        for key in set(hashmap.keys()).difference(smallest_keys):
+            self.num_filtered_entries += len(hashmap[key])
+            del hashmap[key]
+
+        if self._key_upper_bound is None or smallest_keys[-1] < self._key_upper_bound:
+            self._key_upper_bound = smallest_keys[-1]
 
     def _dump_hashmap_to_disk(self, hashmap, filename):
         """
@@ -144,16 +478,78 @@ class GroupByStatement(object):
         3 5
         '
 
+        If hot key handling is enabled, the values of hot keys are appended to their hot key files instead
+        (see _spill_hot_keys) and the keys are left out of the dump.
+
         :param hashmap: the hashmap to dump to disk and then clear it
         :param filename: the filename of the dump
         """
 
-        self.write_key_values_to_file([(key, hashmap[key]) for key in sorted(hashmap.keys())], filename)
+        if self._limit > 0:
+            self._trim_hashmap_to_limit(hashmap)
+
+        # Reserve the disk space before writing, with an upper bound of the size of the dump and the hot key lines
+        reserved_size = 0
+        if self._scheduler is not None:
+            reserved_size = sum(len(str(key)) + 1 + sum(len(value) for value in values) + len(values)
+                                for key, values in hashmap.items())
+            self._reserve_disk(reserved_size)
+
+        num_bytes = 0
+        if self._hot_key_fraction > 0:
+            num_bytes += self._spill_hot_keys(hashmap)
+
+        self._write_dump_file([(key, hashmap[key]) for key in sorted(hashmap.keys())], filename)
+        num_bytes += os.path.getsize(filename)
+        if self._scheduler is not None:
+            self._release_disk(reserved_size - num_bytes)
         self._num_files += 1
         hashmap.clear()
         gc.collect()
 
         self.spills += 1
+        self._save_checkpoint()
+
+    def _spill_hot_keys(self, hashmap):
+        """
+        Detects the hot keys of the hashmap, appends their values to the hot key files and removes them from the
+        hashmap.
+
+        The hashmap already holds the exact number of values of every key since the last spill, so a key is
+        detected as hot once it owns at least hot_key_fraction * max_hashmap_entries of them. At most max_hot_keys
+        keys are hot: when more candidates are found than there is room for, the ones with the most values win.
+        Once hot, a key stays hot for the rest of the request, which keeps its values in input order: the values
+        seen before detection are in the dump files, the ones seen after are in the hot key file.
+
+        :param hashmap: the hashmap about to be dumped to disk
+        :return: the number of bytes appended to the hot key files
+        """
+
+        threshold = max(1, int(self._hot_key_fraction * self._max_hashmap_entries))
+        new_hot_keys = heapq.nlargest(max(0, self._max_hot_keys - len(self._hot_keys)),
+                                      [key for key, values in hashmap.items()
+                                       if key not in self._hot_keys and len(values) >= threshold],
+                                      key=lambda key: len(hashmap[key]))
+        hot_keys = [key for key in hashmap.keys() if key in self._hot_keys] + new_hot_keys
+
+        num_bytes = 0
+        for key in hot_keys:
+            if key not in self._hot_keys:
+                self._hot_keys[key] = self._get_hot_key_filename(key)
+                if self._logger:
+                    self._logger.info("Detected hot key {} with {} values".format(key, len(hashmap[key])))
+
+            line = " ".join(hashmap[key]) + "\n"
+            with open(self._hot_keys[key], "a") as f:
+                f.write(line)
+                if self._checkpoint:
+                    # The manifest written after this spill records the size of the hot key file
+                    f.flush()
+                    os.fsync(f.fileno())
+            num_bytes += len(line)
+            del hashmap[key]
+
+        return num_bytes
 
     def _chunk_input_into_dump_files(self, input_iterator):
         """
@@ -181,17 +577,14 @@ class GroupByStatement(object):
             key, value = next(input_iterator)
             self.total_num_entries += 1
 
-            if self._max_memory > 0 and self.total_num_entries == 1:
-                kv_size = sys.getsizeof(key) + sys.getsizeof(value)
-                self._max_hashmap_entries = self._max_memory // kv_size
-                self._max_num_files = self._max_memory // kv_size
-
-                # Add a maximum limit of 1000 for max_num_files
-                self._max_num_files = min(1000, self._max_num_files)
+            if self._kv_size is None:
+                self._kv_size = sys.getsizeof(key) + sys.getsizeof(value)
+                if self._max_memory > 0:
+                    self._apply_max_memory()
 
-                if self._logger:
-                    self._logger.info("Setting max_hashmap_entries={} and max_num_files={} based on max_memory={}bytes"
-                                      .format(self._max_hashmap_entries, self._max_num_files, self._max_memory))
+            if not self._accept_key(key):
+                self.num_filtered_entries += 1
+                continue
 
             current_hashmap[key].append(str(value))
             current_num_entries += 1
@@ -254,8 +647,16 @@ class GroupByStatement(object):
 
         self._num_files = 0
         self.total_num_entries = 0
+        self.num_filtered_entries = 0
         self.spills = 0
         self.num_merge_stages = 0
+        self._hot_keys = {}
+        self._key_upper_bound = None
+        self._kv_size = None
+
+        if self._checkpoint and self._request_id is not None and os.path.isdir(self._request_id):
+            raise ValueError("Request folder {} already exists, use resume() to continue a checkpointed request"
+                             .format(self._request_id))
 
         # If input is empty return before creating a temporary folder
         if not input_iterator.hasNext():
@@ -272,38 +673,148 @@ class GroupByStatement(object):
         # All files related to this request are going to be stored under this folder
         os.mkdir(self._request_id)
 
-        # Initialize a logger for this request
-        logging.basicConfig(filename="{}.log".format(self._request_id),
-                            format='%(asctime)s %(levelname)s %(message)s',
-                            datefmt='%H:%M:%S',
-                            level=logging.DEBUG)
-        self._logger = logging.getLogger(self._request_id)
+        self._init_logger()
         self._logger.info("Request id: {}".format(self._request_id))
 
+        # The request shares the memory budget of the scheduler until its result is released
+        if self._scheduler is not None:
+            self._scheduler.register(self)
+
+        try:
+            self._stage = "chunking"
+            self._save_checkpoint()
+
+            return self._group_input(input_iterator)
+        except BaseException:
+            self._clean_up_failed_request()
+            raise
+        finally:
+            self._close_logger()
+
+    def resume(self, input_iterator=None, input_offset=0):
+        """
+        Continues a checkpointed request (see checkpoint in __init__) which has been interrupted, from its last
+        finished spill or merge stage. The request folder is given by request_id, and the configuration is read from
+        the manifest, except for key_filter.
+
+        :param input_iterator: iterator over the input stream, starting with the (key, value) pair at position
+                               input_offset. Not used if the whole input had been dumped to disk before the
+                               interruption.
+        :param input_offset: position of the first (key, value) pair of input_iterator in the input stream.
+                             Has to be at most checkpoint_input_offset(request_id); the pairs before that offset are
+                             skipped.
+        :return: same as groupBy
+        """
+
+        self._kv_size = None
+        self._restore_checkpoint(self.load_manifest(self._request_id))
+
+        self._init_logger()
+        self._logger.info("Resuming request id: {} at stage {}".format(self._request_id, self._stage))
+
+        if self._scheduler is not None:
+            self._scheduler.register(self)
+
+        try:
+            # Account for the files written before the interruption, replacing what the interrupted request accounted
+            self._release_disk()
+            self._reserve_disk(sum(os.path.getsize("{}/{}".format(self._request_id, filename))
+                                   for filename in os.listdir(self._request_id)))
+
+            if self._stage == "merging":
+                return self._group_dump_files()
+
+            if input_offset > self.total_num_entries:
+                error_msg = "Unable to resume: input_offset {} is past the checkpointed input offset {}".format(
+                    input_offset, self.total_num_entries)
+                self._logger.error(error_msg)
+                raise ValueError(error_msg)
+
+            # Skip the (key, value) pairs already covered by the checkpoint
+            for _ in range(self.total_num_entries - input_offset):
+                next(input_iterator)
+
+            return self._group_input(input_iterator)
+        except BaseException:
+            self._clean_up_failed_request()
+            raise
+        finally:
+            self._close_logger()
+
+    def _init_logger(self):
+        """
+        Initializes the logger for the current request, writing to its own log file.
+        The logger is not registered with the logging module, so concurrent requests don't share any logging state.
+        """
+        self._log_handler = logging.FileHandler("{}.log".format(self._request_id))
+        self._log_handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s',
+                                                         datefmt='%H:%M:%S'))
+        self._logger = logging.Logger(self._request_id, level=logging.DEBUG)
+        self._logger.addHandler(self._log_handler)
+
+    def _close_logger(self):
+        """
+        Closes the log file of the current request
+        """
+        if self._log_handler is not None:
+            self._logger.removeHandler(self._log_handler)
+            self._log_handler.close()
+            self._log_handler = None
+
+    def _group_input(self, input_iterator):
+        """
+        Stage 1 of groupBy, followed by _group_dump_files if the input doesn't fit in memory
+        """
+
         # Consume the whole stream and chunk it into hashmaps
         result = self._chunk_input_into_dump_files(input_iterator)
 
         self._logger.info("Processed {} (key, value) pairs".format(self.total_num_entries))
+        self._logger.info("Filtered out {} (key, value) pairs".format(self.num_filtered_entries))
         # If the whole stream fits in memory we are done
         if result is not None:
             self._logger.info("The whole input fits in memory")
+            if self._limit > 0:
+                result = {key: result[key] for key in heapq.nsmallest(self._limit, result.keys())}
             self._logger.info("Returned a KeyListIteratorFromMemory")
             shutil.rmtree(self._request_id)
-            return KeyListIteratorFromMemory(result)
+            return KeyListIteratorFromMemory(result, self._ordered, self._get_release_callback())
 
         self._logger.info("Did {} dumps of the hashmap on disk".format(self._num_files))
+
+        self._stage = "merging"
+        self._save_checkpoint()
+
+        return self._group_dump_files()
+
+    def _group_dump_files(self):
+        """
+        Stages 2 and 3 of groupBy
+        """
+
+        # The quota may have been shrunk while consuming the input, size the merges with the current one
+        if self._scheduler is not None:
+            self.set_memory_quota(self._scheduler.memory_quota())
+
         # Merge the dump files by key until at most _max_num_files remain
         self._merge_dump_files()
 
+        if self._hot_keys:
+            self._logger.info("Streaming {} hot keys from their hot key files".format(len(self._hot_keys)))
+
         self._logger.info("Returned a KeyListIteratorFromDisk")
         # At this point there are at most _max_num_files dump files in the current request folder
         return KeyListIteratorFromDisk(self._request_id,
-                                       [self._get_dump_filename(index) for index in range(self._num_files)])
+                                       [self._get_dump_filename(index) for index in range(self._num_files)],
+                                       self._hot_keys,
+                                       self._limit,
+                                       self._get_release_callback())
 
     def remove_log(self):
         """
         Removes the log for the current request
         """
+        self._close_logger()
         try:
             os.remove("{}.log".format(self._request_id))
         except:
@@ -315,13 +826,29 @@ def groupBy(input_iterator,
             max_hashmap_entries=10000000,
             max_memory=-1,
             request_id=None,
-            keep_log=False):
+            keep_log=False,
+            hot_key_fraction=-1,
+            max_hot_keys=64,
+            limit=-1,
+            key_range=None,
+            key_filter=None,
+            checkpoint=False,
+            scheduler=None,
+            ordered=True):
     """
     Wrapper function for the GroupByStatement class.
     Used in order to guarantee thread-safety in case different users use the same GroupByStatement
     See the relevant documentation for GroupByStatement.__init__ and GroupByStatement.groupBy
 
     :param keep_log: If set to False remove the log after a successful execution
+    :param hot_key_fraction: See GroupByStatement.__init__
+    :param max_hot_keys: See GroupByStatement.__init__
+    :param limit: See GroupByStatement.__init__
+    :param key_range: See GroupByStatement.__init__
+    :param key_filter: See GroupByStatement.__init__
+    :param checkpoint: See GroupByStatement.__init__
+    :param scheduler: See GroupByStatement.__init__
+    :param ordered: See GroupByStatement.__init__
 
     >>> it = groupBy (ListIterator([(1, 0), (0, 1), (1, 2), (5, 7)]),\
                       max_num_files=10,\
@@ -340,12 +867,30 @@ def groupBy(input_iterator,
     False
     """
 
-    g = GroupByStatement(max_num_files, max_hashmap_entries, max_memory, request_id)
+    g = GroupByStatement(max_num_files, max_hashmap_entries, max_memory, request_id, hot_key_fraction,
+                         limit, key_range, key_filter, checkpoint, scheduler, ordered, max_hot_keys)
     result_iterator = g.groupBy(input_iterator)
     if not keep_log:
         g.remove_log()
     return result_iterator
 
+
+def resume(request_id, input_iterator=None, input_offset=0, key_filter=None, keep_log=False, scheduler=None):
+    """
+    Wrapper function for GroupByStatement.resume, continuing the checkpointed request stored in the request_id folder.
+    See the relevant documentation for GroupByStatement.resume
+
+    :param key_filter: The key_filter of the interrupted request, which can't be stored in the manifest
+    :param keep_log: If set to False remove the log after a successful execution
+    :param scheduler: See GroupByStatement.__init__
+    """
+
+    g = GroupByStatement(request_id=request_id, key_filter=key_filter, checkpoint=True, scheduler=scheduler)
+    result_iterator = g.resume(input_iterator, input_offset)
+    if not keep_log:
+        g.remove_log()
+    return result_iterator
+
 if __name__ == "__main__":
     import doctest
     (failure_count, test_count) = doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -2,6 +2,10 @@
 import heapq
 import shutil
 import gc
+import itertools
+import functools
+import operator
+import random
 
 
 class JavaIterator(object):
@@ -24,6 +28,21 @@ class JavaIterator(object):
     def next(self):
         return self.__next__()
 
+    def close(self):
+        """
+        Releases the resources held by the iterator, also if it has not been exhausted
+        """
+        pass
+
+    def next_batch(self, n):
+        """
+        Returns a list with the next (at most) n elements, or an empty list if there are none left
+        """
+        batch = []
+        while len(batch) < n and self.hasNext():
+            batch.append(self.__next__())
+        return batch
+
 class MergeFileIterator(JavaIterator):
     """
     Iterator over a K-way merge, by key, on K files.
@@ -38,12 +57,30 @@ class MergeFileIterator(JavaIterator):
 
         # Push the first key in each file on the heap
         for index, f in enumerate(self._files):
-            key = int(next(f))
-            heapq.heappush(self._heap, (key, index, f))
+            try:
+                key = int(next(f))
+                heapq.heappush(self._heap, (key, index, f))
+            except StopIteration:
+                # Empty file, e.g. a dump which only held hot keys
+                f.close()
 
     def hasNext(self):
         return len(self._heap)
 
+    def peek_key(self):
+        """
+        Returns the key which is going to be returned by the next call to next(), without consuming it
+        """
+        return self._heap[0][0]
+
+    def close(self):
+        """
+        Closes the files which have not been fully read, in case the iteration is stopped early
+        """
+        for f in self._files:
+            f.close()
+        self._heap = []
+
     def __next__(self):
         if not self.hasNext():
             raise StopIteration()
@@ -74,6 +111,14 @@ class KeyListIteratorFromMemory(JavaIterator):
     KeyListIterator over the result of GroupByWrapper.groupBy for when the data fits into memory.
     Always initialized with a hashmap
 
+    In ordered mode the keys are sorted lazily, as an incremental quicksort: the keys are partitioned around pivots
+    taken from the smallest eighth of a random sample, descending into the smaller keys only, until at most
+    _FIRST_CHUNK_SIZE keys remain. This takes O(N) and leaves a stack of unsorted pieces growing geometrically in size
+    (by about 8 times), each holding larger keys than the previous one. Every following chunk is the next piece,
+    sorted when it is reached. So the first groups are available after O(N), and the k-th group after O(N + k log k),
+    which is also the cost of sorting all the keys upfront once all of them have been iterated over.
+    In unordered mode the groups are returned in the order of the hashmap, without any sorting.
+
     >>> it = KeyListIteratorFromMemory ({1 : [1, 2, 3], 0 : [4, 5, 6], 2 : [1, 2, 3]})
     >>> it.next()
     (0, [4, 5, 6])
@@ -85,47 +130,168 @@ class KeyListIteratorFromMemory(JavaIterator):
     (2, [1, 2, 3])
     >>> it.hasNext()
     False
+
+    >>> it = KeyListIteratorFromMemory ({1 : [1, 2, 3], 0 : [4, 5, 6], 2 : [1, 2, 3]})
+    >>> it.next_batch(2)
+    [(0, [4, 5, 6]), (1, [1, 2, 3])]
+    >>> it.next_batch(2)
+    [(2, [1, 2, 3])]
+    >>> it.next_batch(2)
+    []
+
+    >>> it = KeyListIteratorFromMemory ({1 : [1, 2, 3], 0 : [4, 5, 6]}, ordered=False)
+    >>> it.next_batch(5)
+    [(1, [1, 2, 3]), (0, [4, 5, 6])]
     """
-    def __init__(self, hashmap):
+
+    # Maximum number of keys in the first chunk
+    _FIRST_CHUNK_SIZE = 64
+
+    def __init__(self, hashmap, ordered=True, on_cleanup=None):
+        """
+        :param hashmap: hashmap of key -> list(values)
+        :param ordered: If True return the groups in ascending order of the keys, else in the order of the hashmap
+        :param on_cleanup: If not None, called once the iterator has been exhausted or closed
+        """
+        self._on_cleanup = on_cleanup
         self._hashmap = hashmap
-        sorted_keys = sorted(hashmap.keys())
-        self._iter = iter(sorted_keys)
-        self._remaining_elements = len(sorted_keys)
+        self._remaining_elements = len(hashmap)
+        if ordered:
+            # No reference to self in the generator, so that a dropped iterator is released (and cleaned up) right away
+            self._iter = itertools.chain.from_iterable(self._sorted_chunks(hashmap))
+        else:
+            self._iter = iter(hashmap.items())
+
+    @classmethod
+    def _sorted_chunks(cls, hashmap):
+        """
+        Generates the groups of the hashmap in ascending order of the keys, one sorted chunk at a time
+        """
+        keys = list(hashmap.keys())
+        # unsorted pieces of keys, each holding larger keys than the next one, the largest keys being in the first one
+        larger_pieces = []
+        while len(keys) > cls._FIRST_CHUNK_SIZE:
+            # skewed towards the smaller keys, so that few partitioning passes are needed to reach the first chunk
+            pivot = sorted(random.sample(keys, 32))[4]
+            larger_keys = list(filter(functools.partial(operator.lt, pivot), keys))
+            larger_keys.append(pivot)
+            larger_pieces.append(larger_keys)
+            keys = list(filter(functools.partial(operator.gt, pivot), keys))
+        larger_pieces.append(keys)
+        while larger_pieces:
+            piece = larger_pieces.pop()
+            piece.sort()
+            yield zip(piece, map(hashmap.__getitem__, piece))
 
     def hasNext(self):
         return self._remaining_elements > 0
 
     def __next__(self):
-        key = next(self._iter)
+        result = next(self._iter)
         self._remaining_elements -= 1
-        return key, self._hashmap[key]
+        if not self._remaining_elements:
+            self.close()
+        return result
+
+    def next_batch(self, n):
+        batch = list(itertools.islice(self._iter, n))
+        self._remaining_elements -= len(batch)
+        if not self._remaining_elements:
+            self.close()
+        return batch
+
+    def close(self):
+        if self._on_cleanup is not None:
+            on_cleanup, self._on_cleanup = self._on_cleanup, None
+            on_cleanup()
+
+    def __del__(self):
+        self.close()
 
 class KeyListIteratorFromDisk(JavaIterator):
     """
     KeyListIterator for when the input stream spills on disk.
     Wraps the MergeFileIterator.
+    Merges in the values of the hot keys, which are streamed from their own files when the key is reached.
     Cleans up after it has processed the last element (hasNext() returns false).
     """
 
-    def __init__(self, request_id, file_list):
+    def __init__(self, request_id, file_list, hot_key_files=None, limit=-1, on_cleanup=None):
         """
         :param request_id: Unique request id used to know the relative path of the dump files.
         :param file_list: A list of filenames for the dump files. Should contain at most self._max_num_files
+        :param hot_key_files: A hashmap of hot key -> filename of the file holding the rest of its values,
+                              one line of values per spill
+        :param limit: If different from -1, stop (and clean up) after limit keys have been returned
+        :param on_cleanup: If not None, called once the request folder has been removed
         """
+        # Nothing to clean up in case the constructor fails
+        self._closed = True
         self._request_id = request_id
         self._merge_file_iterator = MergeFileIterator(file_list)
+        self._hot_key_files = hot_key_files or {}
+        self._hot_keys = sorted(self._hot_key_files.keys())
+        self._hot_key_index = 0
+        self._remaining_elements = limit
+        self._on_cleanup = on_cleanup
+        self._closed = False
+
+    def _read_hot_values(self, key):
+        values = []
+        with open(self._hot_key_files[key]) as f:
+            for line in f:
+                values.extend(line.split())
+        return values
 
     def hasNext(self):
-        return self._merge_file_iterator.hasNext()
+        if self._remaining_elements == 0:
+            return False
+        return self._merge_file_iterator.hasNext() or self._hot_key_index < len(self._hot_keys)
 
     def __next__(self):
-        result = next(self._merge_file_iterator)
+        if not self.hasNext():
+            raise StopIteration()
+
+        if self._hot_key_index < len(self._hot_keys):
+            hot_key = self._hot_keys[self._hot_key_index]
+            if self._merge_file_iterator.hasNext() and self._merge_file_iterator.peek_key() < hot_key:
+                result = next(self._merge_file_iterator)
+            else:
+                # The values stored in the dump files come before the ones in the hot key file
+                if self._merge_file_iterator.hasNext() and self._merge_file_iterator.peek_key() == hot_key:
+                    key, values = next(self._merge_file_iterator)
+                else:
+                    key, values = hot_key, []
+                values.extend(self._read_hot_values(hot_key))
+                self._hot_key_index += 1
+                result = key, values
+        else:
+            result = next(self._merge_file_iterator)
+
+        if self._remaining_elements > 0:
+            self._remaining_elements -= 1
+
         # If we reached the end delete the whole request folder
         if not self.hasNext():
-            gc.collect()
-            shutil.rmtree(self._request_id)
+            self.close()
         return result
 
+    def close(self):
+        """
+        Deletes the whole request folder, also if the result has not been fully consumed
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._merge_file_iterator.close()
+        gc.collect()
+        shutil.rmtree(self._request_id, ignore_errors=True)
+        if self._on_cleanup is not None:
+            self._on_cleanup()
+
+    def __del__(self):
+        self.close()
+
 if __name__ == "__main__":
     import doctest
     (failure_count, test_count) = doctest.testmod(optionflags=doctest.ELLIPSIS)
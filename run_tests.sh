@@ -1,6 +1,7 @@
 #Run doctests
 python groupby.py
 python iterators.py
+python scheduler.py
 
 cd test/
 nosetests --with-doctest --verbosity 3
@@ -0,0 +1,115 @@
+import threading
+
+
+class GroupByScheduler(object):
+    """
+    Shares a global memory and disk budget across the concurrent groupBy requests of a process.
+
+    Every request gets an equal share of max_memory, from the moment it starts consuming its input until its result
+    has been released (exhausted or closed), since its merge stages and its result hold memory as well.
+    While consuming the input the quota sizes the hashmap, during the merge stages it sizes the number of files merged
+    at once. The shares are recomputed whenever a request starts or is released, so requests already running spill
+    earlier when new ones arrive and grow their hashmaps again once the others are done. With many requests the quota
+    can get very small; requests then fall back to a minimum hashmap size and merge fan-in.
+    Disk usage is accounted per request. Also limits the number of merge stages running at the same time, since each of
+    them keeps up to max_num_files files open.
+
+    >>> from groupby import GroupByStatement
+    >>> s = GroupByScheduler(max_memory=1000)
+    >>> first, second = GroupByStatement(scheduler=s), GroupByStatement(scheduler=s)
+    >>> s.register(first)
+    >>> s.register(second)
+    >>> s.memory_quota()
+    500
+    >>> s.unregister(first)
+    >>> s.memory_quota()
+    1000
+    >>> second._max_memory
+    1000
+    """
+
+    def __init__(self, max_memory, max_disk=-1, max_concurrent_merges=2):
+        """
+        :param max_memory: The maximum amount of memory (in bytes) shared by all requests
+        :param max_disk: The maximum amount of disk space (in bytes) used by the dump files of all requests.
+                         If different from -1, a request which exceeds it fails with an IOError.
+        :param max_concurrent_merges: The maximum number of merge stages running at the same time
+        """
+        self._max_memory = max_memory
+        self._max_disk = max_disk
+        # Reentrant, since results release their request from __del__, which may run during garbage collection
+        # while the lock is held by the same thread
+        self._lock = threading.RLock()
+        self._merge_semaphore = threading.BoundedSemaphore(max_concurrent_merges)
+        # requests which have not been released yet
+        self._active_requests = []
+        # request id -> number of bytes used on disk by the request
+        self._disk_usage_per_request = {}
+        # number of bytes currently used on disk by all requests
+        self.disk_usage = 0
+
+    def memory_quota(self):
+        """
+        Returns the amount of memory (in bytes) allocated to each request which has not been released yet
+        """
+        with self._lock:
+            return self._max_memory // max(1, len(self._active_requests))
+
+    def _rebalance(self):
+        """
+        Hands out the new memory quota to every active request. Has to be called while holding the lock.
+        """
+        quota = self._max_memory // max(1, len(self._active_requests))
+        for request in list(self._active_requests):
+            request.set_memory_quota(quota)
+
+    def register(self, request):
+        """
+        Adds a request to the ones sharing the memory budget, shrinking the quota of the others
+        """
+        with self._lock:
+            self._active_requests.append(request)
+            self._rebalance()
+
+    def unregister(self, request):
+        """
+        Removes a request from the ones sharing the memory budget, growing the quota of the others.
+        Called once the result of the request has been released.
+        """
+        with self._lock:
+            self._active_requests.remove(request)
+            self._rebalance()
+
+    def reserve_disk(self, request_id, num_bytes):
+        """
+        Accounts for num_bytes written on disk by the given request.
+        Raises an IOError (without accounting for them) if the disk budget would be exceeded.
+        """
+        with self._lock:
+            if self._max_disk > 0 and self.disk_usage + num_bytes > self._max_disk:
+                raise IOError("Disk budget of {} bytes exceeded: {} bytes in use, {} more requested".format(
+                    self._max_disk, self.disk_usage, num_bytes))
+            self._disk_usage_per_request[request_id] = self._disk_usage_per_request.get(request_id, 0) + num_bytes
+            self.disk_usage += num_bytes
+
+    def release_disk(self, request_id, num_bytes=None):
+        """
+        Accounts for num_bytes removed from disk by the given request, or for all of its files if num_bytes is None
+        """
+        with self._lock:
+            request_usage = self._disk_usage_per_request.pop(request_id, 0)
+            if num_bytes is None or num_bytes >= request_usage:
+                num_bytes = request_usage
+            else:
+                self._disk_usage_per_request[request_id] = request_usage - num_bytes
+            self.disk_usage -= num_bytes
+
+    def merge_slot(self):
+        """
+        Returns a context manager which has to be held while running a merge stage
+        """
+        return self._merge_semaphore
+
+if __name__ == "__main__":
+    import doctest
+    (failure_count, test_count) = doctest.testmod(optionflags=doctest.ELLIPSIS)
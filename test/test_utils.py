@@ -85,6 +85,35 @@ class ListIterator(JavaIterator):
         self.nr_pairs -= 1
         return next(self._iter)
 
+
+class InterruptedIterator(JavaIterator):
+    """
+    Wraps an iterator and raises a RuntimeError after nr_pairs elements, simulating a crash of the process
+
+    >>> it = InterruptedIterator(ListIterator([(1, 0), (2, 1), (3, 0)]), 1)
+    >>> it.next()
+    (1, 0)
+    >>> it.hasNext()
+    True
+    >>> it.next()
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Interrupted after 1 pairs
+    """
+    def __init__(self, iterator, nr_pairs):
+        self._iterator = iterator
+        self._interrupt_after = nr_pairs
+        self.nr_pairs = nr_pairs
+
+    def hasNext(self):
+        return self._iterator.hasNext()
+
+    def __next__(self):
+        if self.nr_pairs == 0:
+            raise RuntimeError("Interrupted after {} pairs".format(self._interrupt_after))
+        self.nr_pairs -= 1
+        return next(self._iterator)
+
 if __name__ == "__main__":
     import doctest
     (failure_count, test_count) = doctest.testmod(optionflags=doctest.ELLIPSIS)
\ No newline at end of file
@@ -3,16 +3,20 @@ Contains tests for:
 * Behaviour of GroupByWrapper.groupBy
 * Behaviour of GroupByWrapper.group_input_into_buckets
 * Behaviour of MergeFileIterator
+* Behaviour of GroupByScheduler
 """
 
 import unittest
 import copy
 import os
 import shutil
+import threading
+import gc
 
-from iterators import MergeFileIterator
-from test.test_utils import IncrementalKeyValueIterator
+from iterators import MergeFileIterator, KeyListIteratorFromMemory
+from test.test_utils import IncrementalKeyValueIterator, ListIterator, InterruptedIterator
 from groupby import GroupByStatement
+from scheduler import GroupByScheduler
 from collections import defaultdict
 
 
@@ -32,13 +36,23 @@ def compute_hashmap(input_iterator):
     return [(key, hashmap[key]) for key in sorted(hashmap.keys())]
 
 
+def remove_request_files():
+    """
+    Helper function which removes the request folders and logs left behind in case something went wrong
+    """
+    _, current_directories, current_files = next(os.walk('.'))
+    for dir in current_directories:
+        if dir.startswith("test_") or dir.startswith("request_"):
+            shutil.rmtree(dir)
+    for filename in current_files:
+        if (filename.startswith("test_") or filename.startswith("request_")) and filename.endswith(".log"):
+            os.remove(filename)
+
+
 class GroupByTests(unittest.TestCase):
     def tearDown(self):
         # Clean up in case something went wrong
-        current_directories = next(os.walk('.'))[1]
-        for dir in current_directories:
-            if dir.startswith("test_") or dir.startswith("request_"):
-                shutil.rmtree(dir)
+        remove_request_files()
 
     def compare_outputs(self, data_copy, result_iterator):
         expected_output = compute_hashmap(data_copy)
@@ -196,3 +210,390 @@ class GroupByTests(unittest.TestCase):
             for key, value in result_iterator_list[index]:
                 pass
             self.assertFalse(os.path.isdir(request_id_list[index]))
+
+    def test_hot_keys(self):
+        g = GroupByStatement(max_num_files=3,
+                             max_hashmap_entries=100,
+                             request_id="test_hot_keys",
+                             hot_key_fraction=0.25)
+
+        # Key 0 makes up most of the stream, key 1 only becomes hot in the second half
+        data = [(0 if index % 4 else index % 17, index) for index in range(1000)]
+        data += [(1 if index % 2 else index % 13, index) for index in range(1000)]
+
+        result_iterator = g.groupBy(ListIterator(data))
+
+        self.assertEqual(sorted(g._hot_keys.keys()), [0, 1])
+        self.assertTrue(g.num_merge_stages > 0)
+        self.compare_outputs(data, result_iterator)
+
+    def test_max_hot_keys(self):
+        g = GroupByStatement(max_num_files=3,
+                             max_hashmap_entries=100,
+                             request_id="test_max_hot_keys",
+                             hot_key_fraction=0.01,
+                             max_hot_keys=3)
+
+        data = IncrementalKeyValueIterator(1000, 20, 7)
+        data_copy = copy.deepcopy(data)
+
+        result_iterator = g.groupBy(data)
+
+        self.assertEqual(len(g._hot_keys), 3)
+        self.compare_outputs(data_copy, result_iterator)
+
+    def test_invalid_hot_key_fraction(self):
+        self.assertRaises(ValueError, GroupByStatement, hot_key_fraction=0)
+        self.assertRaises(ValueError, GroupByStatement, hot_key_fraction=1.5)
+
+    def test_limit_and_key_filters(self):
+        g = GroupByStatement(max_num_files=2,
+                             max_hashmap_entries=20,
+                             request_id="test_limit_and_key_filters",
+                             limit=5,
+                             key_range=(10, 40),
+                             key_filter=lambda key: key % 3 == 0)
+
+        data = IncrementalKeyValueIterator(1000, 50, 7, 7, 3)
+        data_copy = copy.deepcopy(data)
+
+        result_iterator = g.groupBy(data)
+
+        expected_output = [(key, values) for key, values in compute_hashmap(data_copy)
+                           if 10 <= key < 40 and key % 3 == 0][:5]
+        self.assertEqual(list(result_iterator), expected_output)
+        self.assertTrue(g.num_merge_stages > 0)
+        self.assertTrue(g.num_filtered_entries > 0)
+        self.assertFalse(os.path.isdir("test_limit_and_key_filters"))
+
+    def test_invalid_limit(self):
+        self.assertRaises(ValueError, GroupByStatement, limit=0)
+        self.assertRaises(ValueError, GroupByStatement, limit=-2)
+
+    def test_limit_fits_in_memory(self):
+        g = GroupByStatement(max_num_files=10,
+                             max_hashmap_entries=1000,
+                             request_id="test_limit_fits_in_memory",
+                             limit=3)
+
+        data = IncrementalKeyValueIterator(1000, 10, 7)
+        data_copy = copy.deepcopy(data)
+
+        result_iterator = g.groupBy(data)
+
+        self.assertEqual(g.spills, 0)
+        self.assertEqual(list(result_iterator), compute_hashmap(data_copy)[:3])
+
+    def test_resume_during_chunking(self):
+        g = GroupByStatement(max_num_files=3,
+                             max_hashmap_entries=100,
+                             request_id="test_resume_during_chunking",
+                             hot_key_fraction=0.5,
+                             checkpoint=True)
+
+        data = [(0 if index % 3 else index % 11, index) for index in range(1000)]
+
+        self.assertRaises(RuntimeError, g.groupBy, InterruptedIterator(ListIterator(data), 750))
+        input_offset = GroupByStatement.checkpoint_input_offset("test_resume_during_chunking")
+        self.assertEqual(input_offset, 700)
+
+        g = GroupByStatement(request_id="test_resume_during_chunking")
+        result_iterator = g.resume(ListIterator(data[500:]), 500)
+
+        self.assertEqual(g.spills, 10)
+        self.compare_outputs(data, result_iterator)
+        self.assertFalse(os.path.isdir("test_resume_during_chunking"))
+
+    def test_resume_with_truncated_hot_key_file(self):
+        g = GroupByStatement(max_num_files=3,
+                             max_hashmap_entries=100,
+                             request_id="test_resume_with_truncated_hot_key_file",
+                             hot_key_fraction=0.5,
+                             checkpoint=True)
+
+        data = [(0 if index % 3 else index % 11, index) for index in range(1000)]
+
+        self.assertRaises(RuntimeError, g.groupBy, InterruptedIterator(ListIterator(data), 750))
+        self.assertFalse(os.path.exists("test_resume_with_truncated_hot_key_file/dump_0_0.tmp"))
+
+        # Simulate a hot key file which lost its last values in a machine crash
+        with open(g._get_hot_key_filename(0), "a") as f:
+            f.truncate(10)
+
+        g = GroupByStatement(request_id="test_resume_with_truncated_hot_key_file")
+        self.assertRaises(ValueError, g.resume, ListIterator(data))
+
+    def test_groupby_on_existing_checkpoint(self):
+        g = GroupByStatement(max_num_files=3,
+                             max_hashmap_entries=100,
+                             request_id="test_groupby_on_existing_checkpoint",
+                             checkpoint=True)
+
+        data = IncrementalKeyValueIterator(1000, 10, 7)
+        self.assertRaises(RuntimeError, g.groupBy, InterruptedIterator(copy.deepcopy(data), 500))
+
+        # Rerunning groupBy instead of resume() must not orphan the checkpoint
+        self.assertRaises(ValueError, g.groupBy, copy.deepcopy(data))
+        self.assertTrue(os.path.isfile("test_groupby_on_existing_checkpoint/manifest.json"))
+
+    def test_resume_unordered(self):
+        g = GroupByStatement(max_num_files=3,
+                             max_hashmap_entries=1000,
+                             request_id="test_resume_unordered",
+                             checkpoint=True,
+                             ordered=False)
+
+        data = [((index * 7) % 10, index) for index in range(100)]
+        self.assertRaises(RuntimeError, g.groupBy, InterruptedIterator(ListIterator(data), 50))
+
+        g = GroupByStatement(request_id="test_resume_unordered")
+        result_iterator = g.resume(ListIterator(data))
+
+        # Groups come back in hashmap (first seen) order, not sorted
+        result = list(result_iterator)
+        self.assertEqual([key for key, values in result], [0, 7, 4, 1, 8, 5, 2, 9, 6, 3])
+        self.assertEqual(sorted(result), compute_hashmap(data))
+
+    def test_resume_during_merge(self):
+        g = GroupByStatement(max_num_files=2,
+                             max_hashmap_entries=100,
+                             request_id="test_resume_during_merge",
+                             checkpoint=True)
+
+        data = IncrementalKeyValueIterator(1000, 10, 7)
+        data_copy = copy.deepcopy(data)
+
+        # Interrupt the second merge stage after its first merged file
+        def interrupted_merge(key_values_list, filename):
+            if g.num_merge_stages == 1 and os.path.exists(g._get_dump_filename(0, 2)):
+                raise RuntimeError("Interrupted during merge")
+            GroupByStatement.write_key_values_to_file(key_values_list, filename)
+        g.write_key_values_to_file = interrupted_merge
+
+        self.assertRaises(RuntimeError, g.groupBy, data)
+
+        g = GroupByStatement(request_id="test_resume_during_merge")
+        result_iterator = g.resume()
+
+        self.assertEqual(g.spills, 10)
+        self.assertEqual(g.num_merge_stages, 3)
+        self.compare_outputs(data_copy, result_iterator)
+
+    def test_unordered_stream_fits_in_memory(self):
+        g = GroupByStatement(max_num_files=10,
+                             max_hashmap_entries=1000,
+                             request_id="test_unordered_stream_fits_in_memory",
+                             ordered=False)
+
+        data = IncrementalKeyValueIterator(1000, 10, 7, 3)
+        data_copy = copy.deepcopy(data)
+
+        result_iterator = g.groupBy(data)
+
+        self.assertEqual(sorted(result_iterator), compute_hashmap(data_copy))
+
+    def test_next_batch(self):
+        for max_hashmap_entries in [100, 100000]:
+            g = GroupByStatement(max_num_files=10,
+                                 max_hashmap_entries=max_hashmap_entries,
+                                 request_id="test_next_batch")
+
+            data = IncrementalKeyValueIterator(10000, 1000, 7, 3)
+            data_copy = copy.deepcopy(data)
+
+            result_iterator = g.groupBy(data)
+
+            result = []
+            while result_iterator.hasNext():
+                batch = result_iterator.next_batch(300)
+                self.assertTrue(0 < len(batch) <= 300)
+                result.extend(batch)
+            self.assertEqual(result_iterator.next_batch(300), [])
+            self.assertEqual(result, compute_hashmap(data_copy))
+
+    def test_mixed_next_batch_and_next(self):
+        data = IncrementalKeyValueIterator(20000, 5000, 7, 3)
+        expected_output = compute_hashmap(copy.deepcopy(data))
+
+        # Start with a batch larger than the first chunk, then cross chunk boundaries with both calls
+        for first_batch_size in [100, 10]:
+            g = GroupByStatement(max_num_files=10,
+                                 max_hashmap_entries=100000,
+                                 request_id="test_mixed_next_batch_and_next")
+
+            result_iterator = g.groupBy(copy.deepcopy(data))
+
+            result = result_iterator.next_batch(first_batch_size)
+            while result_iterator.hasNext():
+                result.append(next(result_iterator))
+                result.extend(result_iterator.next_batch(997))
+            self.assertEqual(result, expected_output)
+
+    def test_lazy_sort_of_results_in_memory(self):
+        hashmap = {key: [key] for key in range(100000, 0, -7)}
+
+        # The first groups come from a small chunk, and the later chunks grow, so that the k-th group costs
+        # O(N + k log k) instead of always sorting all the keys upfront
+        chunks = [list(chunk) for chunk in KeyListIteratorFromMemory._sorted_chunks(hashmap)]
+        self.assertTrue(0 < len(chunks[0]) <= KeyListIteratorFromMemory._FIRST_CHUNK_SIZE)
+        self.assertTrue(len(chunks[-1]) > KeyListIteratorFromMemory._FIRST_CHUNK_SIZE)
+        self.assertEqual([group for chunk in chunks for group in chunk], sorted(hashmap.items()))
+
+
+class GroupBySchedulerTests(unittest.TestCase):
+    def tearDown(self):
+        # Clean up in case something went wrong
+        remove_request_files()
+
+    def test_memory_quotas(self):
+        s = GroupByScheduler(max_memory=1 << 20)
+        first = GroupByStatement(scheduler=s)
+        second = GroupByStatement(scheduler=s)
+
+        s.register(first)
+        self.assertEqual(first._max_memory, 1 << 20)
+
+        # A new request shrinks the quota of the running ones
+        s.register(second)
+        self.assertEqual(first._max_memory, 1 << 19)
+        self.assertEqual(second._max_memory, 1 << 19)
+
+        # A finished request grows the quota of the remaining ones
+        s.unregister(first)
+        self.assertEqual(second._max_memory, 1 << 20)
+
+    def test_concurrent_requests(self):
+        s = GroupByScheduler(max_memory=1 << 17, max_concurrent_merges=1)
+        num_requests = 8
+        results = [None] * num_requests
+        statements = [GroupByStatement(request_id="test_concurrent_requests_{}".format(index), scheduler=s)
+                      for index in range(num_requests)]
+
+        def run(index):
+            results[index] = list(statements[index].groupBy(IncrementalKeyValueIterator(5000, 37, 11, 3, 2)))
+            statements[index].remove_log()
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(num_requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected_output = compute_hashmap(IncrementalKeyValueIterator(5000, 37, 11, 3, 2))
+        for index in range(num_requests):
+            self.assertTrue(statements[index].spills > 0)
+            self.assertEqual(results[index], expected_output)
+        self.assertEqual(s.disk_usage, 0)
+        self.assertEqual(s.memory_quota(), 1 << 17)
+
+    def test_disk_budget(self):
+        s = GroupByScheduler(max_memory=1 << 12, max_disk=1 << 10)
+        g = GroupByStatement(request_id="test_disk_budget", scheduler=s)
+
+        self.assertRaises(IOError, g.groupBy, IncrementalKeyValueIterator(5000, 37, 11))
+        self.assertFalse(os.path.isdir("test_disk_budget"))
+        self.assertEqual(s.disk_usage, 0)
+
+    def test_failed_request_releases_budget(self):
+        s = GroupByScheduler(max_memory=1 << 12)
+        g = GroupByStatement(request_id="test_failed_request_releases_budget", scheduler=s)
+
+        data = InterruptedIterator(IncrementalKeyValueIterator(5000, 37, 11), 2000)
+        self.assertRaises(RuntimeError, g.groupBy, data)
+        g.remove_log()
+
+        self.assertFalse(os.path.isdir("test_failed_request_releases_budget"))
+        self.assertEqual(s.disk_usage, 0)
+        self.assertEqual(s._active_requests, [])
+
+    def test_dropped_result_releases_budget(self):
+        s = GroupByScheduler(max_memory=1 << 12)
+        g = GroupByStatement(request_id="test_dropped_result_releases_budget", scheduler=s)
+
+        result_iterator = g.groupBy(IncrementalKeyValueIterator(5000, 37, 11))
+        g.remove_log()
+        next(result_iterator)
+        self.assertTrue(s.disk_usage > 0)
+
+        del result_iterator
+        self.assertFalse(os.path.isdir("test_dropped_result_releases_budget"))
+        self.assertEqual(s.disk_usage, 0)
+        self.assertEqual(s._active_requests, [])
+
+        # Results in memory are released as well, without waiting for the garbage collector
+        s = GroupByScheduler(max_memory=1 << 20)
+        g = GroupByStatement(request_id="test_dropped_result_releases_budget", scheduler=s)
+        gc.disable()
+        try:
+            result_iterator = g.groupBy(IncrementalKeyValueIterator(100, 10, 7))
+            g.remove_log()
+            next(result_iterator)
+            self.assertTrue(isinstance(result_iterator, KeyListIteratorFromMemory))
+            self.assertEqual(s._active_requests, [g])
+            del result_iterator
+            self.assertEqual(s._active_requests, [])
+        finally:
+            gc.enable()
+
+    def test_memory_quota_held_until_result_released(self):
+        s = GroupByScheduler(max_memory=1 << 20)
+        first = GroupByStatement(request_id="test_memory_quota_held_0", scheduler=s)
+        second = GroupByStatement(request_id="test_memory_quota_held_1", scheduler=s)
+
+        first_result = first.groupBy(IncrementalKeyValueIterator(100, 10, 7))
+        second_result = second.groupBy(IncrementalKeyValueIterator(100, 10, 7))
+        first.remove_log()
+        second.remove_log()
+
+        # The in-memory result of the first request still counts against the budget
+        self.assertEqual(second._max_memory, 1 << 19)
+
+        list(first_result)
+        self.assertEqual(second._max_memory, 1 << 20)
+
+        second_result.close()
+        self.assertEqual(s._active_requests, [])
+
+    def test_small_memory_quota(self):
+        s = GroupByScheduler(max_memory=4096)
+        others = [GroupByStatement(scheduler=s) for _ in range(40)]
+        for other in others:
+            s.register(other)
+
+        g = GroupByStatement(request_id="test_small_memory_quota", scheduler=s)
+        data = IncrementalKeyValueIterator(1000, 10, 7)
+        data_copy = copy.deepcopy(data)
+
+        result_iterator = g.groupBy(data)
+        g.remove_log()
+
+        self.assertTrue(g.num_merge_stages > 0)
+        self.assertEqual(g._max_num_files, GroupByStatement._MIN_NUM_FILES)
+        self.assertEqual(list(result_iterator), compute_hashmap(data_copy))
+
+    def test_merge_error_keeps_checkpoint(self):
+        g = GroupByStatement(max_num_files=1,
+                             max_hashmap_entries=100,
+                             request_id="test_merge_error_keeps_checkpoint",
+                             checkpoint=True)
+
+        self.assertRaises(ValueError, g.groupBy, IncrementalKeyValueIterator(1000, 10, 7))
+        self.assertTrue(os.path.isfile("test_merge_error_keeps_checkpoint/manifest.json"))
+
+    def test_disk_budget_checked_before_writing(self):
+        s = GroupByScheduler(max_memory=1 << 12, max_disk=1 << 10)
+        g = GroupByStatement(request_id="test_disk_budget_checked_before_writing", scheduler=s)
+
+        written_sizes = []
+
+        def write_key_values_to_file(key_values_list, filename):
+            GroupByStatement.write_key_values_to_file(key_values_list, filename)
+            written_sizes.append(os.path.getsize(filename))
+        g.write_key_values_to_file = write_key_values_to_file
+
+        self.assertRaises(IOError, g.groupBy, IncrementalKeyValueIterator(5000, 37, 11))
+        g.remove_log()
+
+        # The spill which would have exceeded the budget has not been written
+        self.assertTrue(sum(written_sizes) <= 1 << 10)
+        self.assertEqual(s.disk_usage, 0)